@@ -5,7 +5,8 @@ Phân tích và xử lý boot sector cho công cụ khôi phục FAT
 """
 
 import struct
-from typing import Dict, List
+from collections import namedtuple
+from typing import Dict, List, Tuple
 from constants import (
     BOOT_SIGNATURE, VALID_BYTES_PER_SECTOR, VALID_SECTORS_PER_CLUSTER,
     VALID_NUM_FATS, VALID_MEDIA_DESCRIPTORS, FAT12_MAX_CLUSTERS, FAT16_MAX_CLUSTERS,
@@ -15,13 +16,30 @@ from constants import (
 )
 from disk_utils import hex_dump
 
+# Các instance struct.Struct là hằng số cấp module, dùng chung cho mọi lần
+# phân tích - không tạo lại trong hàm.
+# BPB chung FAT12/16/32: offset 11..36
+_BPB_STRUCT = struct.Struct('<HBHBHHBHHHII')
+BPBFields = namedtuple('BPBFields', [
+    'bytes_per_sector', 'sectors_per_cluster', 'reserved_sectors', 'num_fats',
+    'root_entries', 'total_sectors_16', 'media_descriptor', 'sectors_per_fat_16',
+    'sectors_per_track', 'num_heads', 'hidden_sectors', 'total_sectors_32',
+])
+# Phần BPB mở rộng của FAT32: offset 36..52
+_FAT32_EXT_STRUCT = struct.Struct('<IHHIHH')
+
+
+def _unpack_bpb(boot_data: bytes) -> BPBFields:
+    """Giải mã toàn bộ BPB chung (offset 11..36) trong một lần unpack"""
+    return BPBFields._make(_BPB_STRUCT.unpack_from(boot_data, 11))
+
 
 class BootSectorParser:
     """Lớp phân tích boot sector"""
     
     @staticmethod
     def parse_boot_sector(boot_data: bytes) -> Dict:
-        """Phân tích boot sector và trích xuất thông tin"""
+        """Phân tích boot sector và trích xuất thông tin (nhận bytes, bytearray hoặc memoryview)"""
         if len(boot_data) < 512:
             raise ValueError("Boot sector không đủ 512 bytes")
         
@@ -35,53 +53,45 @@ class BootSectorParser:
             # Không raise exception, tiếp tục phân tích
         
         # Trích xuất thông tin cơ bản với error handling
-        info = {}
         try:
-            info['oem_name'] = boot_data[3:11].decode('ascii', errors='ignore').strip()
-            info['bytes_per_sector'] = struct.unpack('<H', boot_data[11:13])[0]
-            info['sectors_per_cluster'] = boot_data[13]
-            info['reserved_sectors'] = struct.unpack('<H', boot_data[14:16])[0]
-            info['num_fats'] = boot_data[16]
-            info['root_entries'] = struct.unpack('<H', boot_data[17:19])[0]
-            info['total_sectors_16'] = struct.unpack('<H', boot_data[19:21])[0]
-            info['media_descriptor'] = boot_data[21]
-            info['sectors_per_fat_16'] = struct.unpack('<H', boot_data[22:24])[0]
-            info['sectors_per_track'] = struct.unpack('<H', boot_data[24:26])[0]
-            info['num_heads'] = struct.unpack('<H', boot_data[26:28])[0]
-            info['hidden_sectors'] = struct.unpack('<I', boot_data[28:32])[0]
-            info['total_sectors_32'] = struct.unpack('<I', boot_data[32:36])[0]
+            oem_name = bytes(boot_data[3:11]).decode('ascii', errors='ignore').strip()
+            bpb = _unpack_bpb(boot_data)
             
             # Debug: hiển thị các giá trị quan trọng
             print("Debug values:")
-            print(f"  bytes_per_sector: {info['bytes_per_sector']}")
-            print(f"  sectors_per_cluster: {info['sectors_per_cluster']}")
-            print(f"  total_sectors_16: {info['total_sectors_16']}")
-            print(f"  total_sectors_32: {info['total_sectors_32']}")
+            print(f"  bytes_per_sector: {bpb.bytes_per_sector}")
+            print(f"  sectors_per_cluster: {bpb.sectors_per_cluster}")
+            print(f"  total_sectors_16: {bpb.total_sectors_16}")
+            print(f"  total_sectors_32: {bpb.total_sectors_32}")
             
             # Kiểm tra giá trị 0 trước khi tính toán
-            if info['bytes_per_sector'] == 0:
+            if bpb.bytes_per_sector == 0:
                 raise ValueError("bytes_per_sector = 0, boot sector bị hỏng")
-            if info['sectors_per_cluster'] == 0:
+            if bpb.sectors_per_cluster == 0:
                 raise ValueError("sectors_per_cluster = 0, boot sector bị hỏng")
-            
-            # Xác định tổng số sector
-            info['total_sectors'] = info['total_sectors_32'] if info['total_sectors_16'] == 0 else info['total_sectors_16']
-            
-            if info['total_sectors'] == 0:
+            if (bpb.total_sectors_16 or bpb.total_sectors_32) == 0:
                 raise ValueError("total_sectors = 0, boot sector bị hỏng")
                 
         except Exception as e:
             raise ValueError(f"Lỗi khi phân tích boot sector: {str(e)}")
         
+        return BootSectorParser._info_from_bpb(oem_name, bpb, boot_data)
+    
+    @staticmethod
+    def _info_from_bpb(oem_name: str, bpb: BPBFields, boot_data: bytes) -> Dict:
+        """Tính thông tin boot sector từ BPB đã giải mã (dùng chung cho parser và generator)"""
+        info = {'oem_name': oem_name}
+        info.update(bpb._asdict())
+        
+        # Xác định tổng số sector
+        # Theo chuẩn FAT chỉ một trong hai trường khác 0
+        info['total_sectors'] = bpb.total_sectors_16 or bpb.total_sectors_32
+        
         # Phân tích thêm cho FAT32
         if info['sectors_per_fat_16'] == 0:
             # FAT32
-            info['sectors_per_fat'] = struct.unpack('<I', boot_data[36:40])[0]
-            info['ext_flags'] = struct.unpack('<H', boot_data[40:42])[0]
-            info['fs_version'] = struct.unpack('<H', boot_data[42:44])[0]
-            info['root_cluster'] = struct.unpack('<I', boot_data[44:48])[0]
-            info['fs_info'] = struct.unpack('<H', boot_data[48:50])[0]
-            info['backup_boot_sec'] = struct.unpack('<H', boot_data[50:52])[0]
+            (info['sectors_per_fat'], info['ext_flags'], info['fs_version'],
+             info['root_cluster'], info['fs_info'], info['backup_boot_sec']) = _FAT32_EXT_STRUCT.unpack_from(boot_data, 36)
             info['fat_type'] = 32
         else:
             # FAT12/FAT16
@@ -99,6 +109,17 @@ class BootSectorParser:
         
         return info
     
+    @staticmethod
+    def looks_like_boot_sector(boot_data: bytes) -> bool:
+        """Kiểm tra nhanh (không raise) xem data có thể là boot sector FAT không"""
+        if len(boot_data) < 512 or boot_data[510:512] != BOOT_SIGNATURE:
+            return False
+        
+        bpb = _unpack_bpb(boot_data)
+        return (bpb.bytes_per_sector in VALID_BYTES_PER_SECTOR
+                and bpb.sectors_per_cluster in VALID_SECTORS_PER_CLUSTER
+                and (bpb.total_sectors_16 or bpb.total_sectors_32) > 0)
+    
     @staticmethod
     def _determine_fat_type(info: Dict) -> int:
         """Xác định loại FAT dựa trên số cluster"""
@@ -117,42 +138,47 @@ class BootSectorValidator:
     @staticmethod
     def validate_boot_sector(info: Dict, disk_size: int = 0) -> List[str]:
         """Kiểm tra tính hợp lệ của boot sector và trả về danh sách lỗi"""
+        return [message for _, message in BootSectorValidator.check_boot_sector(info, disk_size)]
+    
+    @staticmethod
+    def check_boot_sector(info: Dict, disk_size: int = 0) -> List[Tuple[str, str]]:
+        """Kiểm tra boot sector, trả về danh sách (tên trường lỗi, thông báo lỗi)"""
         errors = []
         
         # Kiểm tra bytes per sector
         if info['bytes_per_sector'] not in VALID_BYTES_PER_SECTOR:
-            errors.append(f"Bytes per sector không hợp lệ: {info['bytes_per_sector']} (phải là {VALID_BYTES_PER_SECTOR})")
+            errors.append(('bytes_per_sector', f"Bytes per sector không hợp lệ: {info['bytes_per_sector']} (phải là {VALID_BYTES_PER_SECTOR})"))
         
         # Kiểm tra sectors per cluster
         if info['sectors_per_cluster'] not in VALID_SECTORS_PER_CLUSTER:
-            errors.append(f"Sectors per cluster không hợp lệ: {info['sectors_per_cluster']} (phải là {VALID_SECTORS_PER_CLUSTER})")
+            errors.append(('sectors_per_cluster', f"Sectors per cluster không hợp lệ: {info['sectors_per_cluster']} (phải là {VALID_SECTORS_PER_CLUSTER})"))
         
         # Kiểm tra số FAT
         if info['num_fats'] not in VALID_NUM_FATS:
-            errors.append(f"Số lượng bảng FAT không hợp lệ: {info['num_fats']} (phải là 1 hoặc 2)")
+            errors.append(('num_fats', f"Số lượng bảng FAT không hợp lệ: {info['num_fats']} (phải là 1 hoặc 2)"))
         
         # Kiểm tra reserved sectors
         if info['fat_type'] == 32:
             if info['reserved_sectors'] < FAT32_MIN_RESERVED_SECTORS:
-                errors.append(f"Reserved sectors cho FAT32 quá nhỏ: {info['reserved_sectors']} (nên >= {FAT32_MIN_RESERVED_SECTORS})")
+                errors.append(('reserved_sectors', f"Reserved sectors cho FAT32 quá nhỏ: {info['reserved_sectors']} (nên >= {FAT32_MIN_RESERVED_SECTORS})"))
         else:
             if info['reserved_sectors'] < 1:
-                errors.append(f"Reserved sectors quá nhỏ: {info['reserved_sectors']} (phải >= 1)")
+                errors.append(('reserved_sectors', f"Reserved sectors quá nhỏ: {info['reserved_sectors']} (phải >= 1)"))
         
         # Kiểm tra tổng số sector với kích thước đĩa thực tế
         if disk_size > 0:
             expected_sectors = disk_size // info['bytes_per_sector']
             diff_percent = abs(info['total_sectors'] - expected_sectors) / expected_sectors * 100
             if diff_percent > 5:  # Cho phép sai lệch 5%
-                errors.append(f"Tổng số sector không khớp với kích thước đĩa: {info['total_sectors']} vs {expected_sectors}")
+                errors.append(('total_sectors', f"Tổng số sector không khớp với kích thước đĩa: {info['total_sectors']} vs {expected_sectors}"))
         
         # Kiểm tra root entries cho FAT12/16
         if info['fat_type'] != 32 and info['root_entries'] == 0:
-            errors.append("Root entries = 0 không hợp lệ cho FAT12/16")
+            errors.append(('root_entries', "Root entries = 0 không hợp lệ cho FAT12/16"))
         
         # Kiểm tra media descriptor
         if info['media_descriptor'] not in VALID_MEDIA_DESCRIPTORS:
-            errors.append(f"Media descriptor không hợp lệ: 0x{info['media_descriptor']:02X}")
+            errors.append(('media_descriptor', f"Media descriptor không hợp lệ: 0x{info['media_descriptor']:02X}"))
         
         return errors
 
@@ -161,17 +187,17 @@ class BootSectorGenerator:
     """Lớp tạo boot sector tối ưu"""
     
     @staticmethod
-    def generate_optimal_boot_sector(damaged_boot: bytes, disk_size: int = 0) -> bytes:
-        """Tạo boot sector tối ưu dựa trên thông tin có sẵn và kích thước đĩa"""
+    def generate_optimal_boot_sector(damaged_boot: bytes, disk_size: int = 0) -> Tuple[bytes, Dict]:
+        """Tạo boot sector tối ưu, trả về (boot sector mới, thông tin boot sector mới)"""
         print("\n=== TẠO BOOT SECTOR TỐI ƯU ===")
         
         # Bắt đầu với boot sector bị hỏng
         new_boot = bytearray(damaged_boot)
         
         # Lấy thông tin có thể tin cậy từ boot sector cũ
-        total_sectors_16 = struct.unpack('<H', damaged_boot[19:21])[0]
-        total_sectors_32 = struct.unpack('<I', damaged_boot[32:36])[0]
-        total_sectors = total_sectors_32 if total_sectors_16 == 0 else total_sectors_16
+        bpb = _unpack_bpb(damaged_boot)
+        # Theo chuẩn FAT chỉ một trong hai trường khác 0
+        total_sectors = bpb.total_sectors_16 or bpb.total_sectors_32
         
         print(f"Phát hiện tổng sectors từ boot sector: {total_sectors}")
         
@@ -199,17 +225,17 @@ class BootSectorGenerator:
         
         # Xác định FAT type dựa trên data clusters
         temp_clusters = data_sectors // sectors_per_cluster
+        # Tính dung lượng FAT bằng số nguyên
+        max_clusters = temp_clusters
         if temp_clusters < FAT12_MAX_CLUSTERS:
-            # FAT12 - 1.5 bytes per entry
-            fat_entry_size = 1.5
+            # FAT12 - 1.5 bytes per entry (2 entry trong 3 bytes), làm tròn lên
+            fat_size_bytes = (max_clusters * 3 + 1) // 2
         else:
-            # FAT16 - 2 bytes per entry  
-            fat_entry_size = 2
+            # FAT16 - 2 bytes per entry
+            fat_size_bytes = max_clusters * 2
         
         # Tính sectors per FAT
-        max_clusters = temp_clusters
-        fat_size_bytes = max_clusters * fat_entry_size
-        sectors_per_fat = int((fat_size_bytes + bytes_per_sector - 1) // bytes_per_sector)
+        sectors_per_fat = (fat_size_bytes + bytes_per_sector - 1) // bytes_per_sector
         
         # Kiểm tra và điều chỉnh
         if sectors_per_fat > data_sectors // 4:  # Không nên quá 25% data sectors
@@ -228,24 +254,31 @@ class BootSectorGenerator:
         print(f"  Sectors per FAT: {sectors_per_fat}")
         print(f"  Total sectors: {total_sectors}")
         
-        # Ghi các giá trị vào boot sector mới
-        struct.pack_into('<H', new_boot, 11, bytes_per_sector)  # bytes per sector
-        new_boot[13] = sectors_per_cluster  # sectors per cluster
-        struct.pack_into('<H', new_boot, 14, reserved_sectors)  # reserved sectors
-        new_boot[16] = num_fats  # number of FATs
-        struct.pack_into('<H', new_boot, 17, root_entries)  # root entries
-        
+        # Ghi các giá trị vào boot sector mới trong một lần pack (offset 11..36);
+        # sectors per track, số head và hidden sectors giữ nguyên từ boot sector cũ
         if total_sectors < 65536:
-            struct.pack_into('<H', new_boot, 19, total_sectors)  # total sectors 16
-            struct.pack_into('<I', new_boot, 32, 0)  # total sectors 32
+            total_sectors_16, total_sectors_32 = total_sectors, 0
         else:
-            struct.pack_into('<H', new_boot, 19, 0)  # total sectors 16
-            struct.pack_into('<I', new_boot, 32, total_sectors)  # total sectors 32
+            total_sectors_16, total_sectors_32 = 0, total_sectors
         
-        new_boot[21] = media_descriptor  # media descriptor
-        struct.pack_into('<H', new_boot, 22, sectors_per_fat)  # sectors per FAT
+        new_bpb = bpb._replace(
+            bytes_per_sector=bytes_per_sector,
+            sectors_per_cluster=sectors_per_cluster,
+            reserved_sectors=reserved_sectors,
+            num_fats=num_fats,
+            root_entries=root_entries,
+            total_sectors_16=total_sectors_16,
+            media_descriptor=media_descriptor,
+            sectors_per_fat_16=sectors_per_fat,
+            total_sectors_32=total_sectors_32,
+        )
+        _BPB_STRUCT.pack_into(new_boot, 11, *new_bpb)
         
         # Cập nhật boot signature nếu cần
         new_boot[510:512] = BOOT_SIGNATURE
         
-        return bytes(new_boot)
+        # Thông tin boot sector mới, tính qua cùng đường với parse_boot_sector
+        oem_name = bytes(damaged_boot[3:11]).decode('ascii', errors='ignore').strip()
+        info = BootSectorParser._info_from_bpb(oem_name, new_bpb, new_boot)
+        
+        return bytes(new_boot), info
@@ -4,42 +4,55 @@ Command Line Interface for FAT Recovery Tool
 Giao diện dòng lệnh cho công cụ khôi phục FAT
 """
 
-import argparse
+import os
 import sys
+from types import SimpleNamespace
+from typing import Optional
+from constants import CLI_HELP
 from fat_analyzer import FATAnalyzer
 
 
+# Các cờ dòng lệnh -> tên thuộc tính trong args
+CLI_FLAGS = {
+    '--recovery': 'recovery',
+    '--info-only': 'info_only',
+    '--verify': 'verify',
+}
+
+
 class FATRecoveryCLI:
     """Lớp xử lý giao diện dòng lệnh"""
     
-    def __init__(self):
-        self.parser = self._create_parser()
+    def __init__(self, prog: Optional[str] = None):
+        self.prog = prog or os.path.basename(sys.argv[0])
     
-    def _create_parser(self) -> argparse.ArgumentParser:
-        """Tạo argument parser"""
-        parser = argparse.ArgumentParser(
-            description="FAT Data Recovery Tool - Công cụ phân tích và khôi phục boot sector",
-            formatter_class=argparse.RawDescriptionHelpFormatter,
-            epilog="""
-Ví dụ sử dụng:
-  python fat_recovery.py E              # Phân tích ổ đĩa E:
-  python fat_recovery.py D --recovery   # Phân tích và khôi phục ổ đĩa D:
-  python fat_recovery.py F --info-only  # Chỉ hiển thị thông tin, không khôi phục
-            """
-        )
+    def _parse_args(self, args=None) -> SimpleNamespace:
+        """Phân tích tham số dòng lệnh (không dùng argparse để khởi động nhanh)"""
+        argv = sys.argv[1:] if args is None else list(args)
+        parsed = SimpleNamespace(drive=None, **{attr: False for attr in CLI_FLAGS.values()})
         
-        parser.add_argument('drive', help='Chữ cái ổ đĩa (ví dụ: E, D)')
-        parser.add_argument('--recovery', action='store_true', 
-                           help='Thực hiện khôi phục tương tác nếu phát hiện lỗi')
-        parser.add_argument('--info-only', action='store_true',
-                           help='Chỉ hiển thị thông tin phân tích, không khôi phục')
+        for arg in argv:
+            if arg in ('-h', '--help'):
+                print(CLI_HELP.format(prog=self.prog))
+                raise SystemExit(0)
+            if arg in CLI_FLAGS:
+                setattr(parsed, CLI_FLAGS[arg], True)
+            elif arg.startswith('-'):
+                raise ValueError(f"Tham số không hợp lệ: {arg}")
+            elif parsed.drive is None:
+                parsed.drive = arg
+            else:
+                raise ValueError(f"Tham số thừa: {arg}")
         
-        return parser
+        if parsed.drive is None:
+            raise ValueError("Thiếu tham số drive (ví dụ: E)")
+        
+        return parsed
     
     def run(self, args=None) -> int:
         """Chạy CLI với các tham số"""
         try:
-            parsed_args = self.parser.parse_args(args)
+            parsed_args = self._parse_args(args)
             return self._execute(parsed_args)
         except KeyboardInterrupt:
             print("\nĐã hủy thao tác.")
@@ -57,10 +70,9 @@ Ví dụ sử dụng:
             print("Lỗi: Vui lòng nhập một chữ cái ổ đĩa hợp lệ (ví dụ: E)")
             return 1
         
-        analyzer = FATAnalyzer(drive_letter)
-        result = analyzer.run_analysis()
-        
-        return self._handle_analysis_result(result, args, analyzer)
+        with FATAnalyzer(drive_letter) as analyzer:
+            result = analyzer.run_analysis()
+            return self._handle_analysis_result(result, args, analyzer)
     
     def _handle_analysis_result(self, result: dict, args, analyzer: FATAnalyzer) -> int:
         """Xử lý kết quả phân tích"""
@@ -85,7 +97,7 @@ Ví dụ sử dụng:
         """Xử lý khôi phục"""
         if args.recovery and not args.info_only:
             print(f"\nThực hiện khôi phục boot sector {issue_type}...")
-            if analyzer.repair_boot_sector():
+            if analyzer.repair_boot_sector(verify=args.verify):
                 print("✓ Khôi phục thành công!")
                 return 0
             else:
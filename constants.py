@@ -34,11 +34,34 @@ DEFAULT_MEDIA_DESCRIPTOR = 0xF8  # Fixed disk
 # FAT32 minimum reserved sectors
 FAT32_MIN_RESERVED_SECTORS = 32
 
+# Vị trí boot sector dự phòng thường gặp (FAT32 mặc định ở sector 6)
+BACKUP_BOOT_SECTORS = [6, 12]
+
 # Sector size
 SECTOR_SIZE = 512
 
-# Windows disk geometry IOCTL code
+# Windows disk IOCTL codes
 IOCTL_DISK_GET_DRIVE_GEOMETRY = 0x00070000
+IOCTL_DISK_GET_LENGTH_INFO = 0x0007405C
 
 # Default disk size for estimation (20MB)
 DEFAULT_DISK_SIZE_SECTORS = 40960  # 20MB / 512
+
+# Command line help, shared by main.py (fast path) and cli.py
+CLI_HELP = """usage: {prog} [-h] [--recovery] [--info-only] [--verify] drive
+
+FAT Data Recovery Tool - Công cụ phân tích và khôi phục boot sector
+
+positional arguments:
+  drive        Chữ cái ổ đĩa (ví dụ: E, D)
+
+options:
+  -h, --help   Hiển thị help này
+  --recovery   Thực hiện khôi phục tương tác nếu phát hiện lỗi
+  --info-only  Chỉ hiển thị thông tin phân tích, không khôi phục
+  --verify     Phân tích lại boot sector sau khi sửa chữa để kiểm tra
+
+Ví dụ sử dụng:
+  python {prog} E              # Phân tích ổ đĩa E:
+  python {prog} D --recovery   # Phân tích và khôi phục ổ đĩa D:
+  python {prog} F --info-only  # Chỉ hiển thị thông tin, không khôi phục"""
@@ -5,9 +5,27 @@ Các tiện ích xử lý đĩa cho công cụ khôi phục FAT
 """
 
 import os
+import shutil
 import struct
 from typing import Optional
-from constants import SECTOR_SIZE, IOCTL_DISK_GET_DRIVE_GEOMETRY
+from constants import SECTOR_SIZE, IOCTL_DISK_GET_DRIVE_GEOMETRY, IOCTL_DISK_GET_LENGTH_INFO
+
+# pywin32 là tùy chọn (chỉ có trên Windows)
+try:
+    import win32file
+    import pywintypes
+except ImportError:
+    win32file = None
+    pywintypes = None
+
+# Cache kích thước ổ đĩa theo chữ cái ổ đĩa
+_disk_size_cache = {}
+
+# Layout kết quả IOCTL, tạo một lần ở cấp module
+# GET_LENGTH_INFORMATION: LARGE_INTEGER Length
+_LENGTH_INFO_STRUCT = struct.Struct('<q')
+# DISK_GEOMETRY: Cylinders, MediaType, TracksPerCylinder, SectorsPerTrack, BytesPerSector
+_DISK_GEOMETRY_STRUCT = struct.Struct('<qIIII')
 
 
 class DiskReader:
@@ -16,10 +34,34 @@ class DiskReader:
     def __init__(self, drive_letter: str):
         self.drive_letter = drive_letter.upper()
         self.drive_path = f"\\\\.\\{self.drive_letter}:"
+        self._session = False
+        self._handle = None
+    
+    def __enter__(self):
+        """Bắt đầu phiên đọc: giữ một handle đọc mở cho tất cả read_sector"""
+        self._session = True
+        return self
+    
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._session = False
+        self._close_handle()
+        return False
+    
+    def _close_handle(self) -> None:
+        """Đóng handle đọc của phiên (nếu có)"""
+        if self._handle is not None:
+            self._handle.close()
+            self._handle = None
     
     def read_sector(self, sector_num: int, num_sectors: int = 1) -> bytes:
         """Đọc sector từ ổ đĩa"""
         try:
+            if self._session:
+                # Handle được mở ở lần đọc đầu tiên và dùng lại tới hết phiên
+                if self._handle is None:
+                    self._handle = open(self.drive_path, 'rb')
+                self._handle.seek(sector_num * SECTOR_SIZE)
+                return self._handle.read(num_sectors * SECTOR_SIZE)
             with open(self.drive_path, 'rb') as drive:
                 drive.seek(sector_num * SECTOR_SIZE)
                 return drive.read(num_sectors * SECTOR_SIZE)
@@ -28,113 +70,139 @@ class DiskReader:
     
     def write_sector(self, sector_num: int, data: bytes) -> bool:
         """Ghi data vào sector"""
+        # Bỏ handle đọc của phiên để lần đọc sau không dùng dữ liệu cũ trong buffer
+        self._close_handle()
         try:
             with open(self.drive_path, 'r+b') as drive:
                 drive.seek(sector_num * SECTOR_SIZE)
                 drive.write(data)
                 drive.flush()
+                # Đảm bảo dữ liệu đã xuống đĩa trước khi báo thành công
+                os.fsync(drive.fileno())
             return True
         except Exception as e:
             raise Exception(f"Không thể ghi sector {sector_num}: {str(e)}")
     
     def get_disk_size(self) -> int:
+        """Lấy kích thước ổ đĩa (có cache theo ổ đĩa)"""
+        if self.drive_letter not in _disk_size_cache:
+            size = self._query_disk_size()
+            if size == 0:
+                # Không cache kết quả thất bại để lần sau thử lại
+                return 0
+            _disk_size_cache[self.drive_letter] = size
+        return _disk_size_cache[self.drive_letter]
+    
+    def _open_win32_handle(self):
+        """Mở handle pywin32 tới volume (chỉ đọc)"""
+        return win32file.CreateFile(
+            self.drive_path,
+            win32file.GENERIC_READ,
+            win32file.FILE_SHARE_READ | win32file.FILE_SHARE_WRITE,
+            None,
+            win32file.OPEN_EXISTING,
+            0,
+            None
+        )
+    
+    def _query_disk_size(self) -> int:
         """Lấy kích thước ổ đĩa với multiple fallback methods"""
         
-        # Method 1: Try shutil.disk_usage (most reliable for mounted drives)
-        try:
-            import shutil
-            drive_root = f"{self.drive_letter}:\\"
-            total, used, free = shutil.disk_usage(drive_root)
-            return total
-        except Exception as e:
-            print(f"Method 1 (shutil) failed: {e}")
-        
-        # Method 2: Try pywin32 if available
-        try:
-            import win32file
-            import pywintypes
-            handle = win32file.CreateFile(
-                self.drive_path,
-                win32file.GENERIC_READ,
-                win32file.FILE_SHARE_READ | win32file.FILE_SHARE_WRITE,
-                None,
-                win32file.OPEN_EXISTING,
-                0,
-                None
-            )
+        # Method 1-3 cần pywin32
+        if win32file is None:
+            print("pywin32 not available")
+        else:
+            # Method 1: IOCTL_DISK_GET_LENGTH_INFO - kích thước thật của volume thô,
+            # không cần filesystem hợp lệ và không đọc dữ liệu
             try:
-                # For physical drives, use different approach
-                if self.drive_path.startswith('\\\\.\\PhysicalDrive'):
-                    # Try to get partition info instead
-                    try:
-                        size_low, size_high = win32file.GetFileSize(handle)
-                        if size_high == 0 and size_low > 0:
-                            return size_low
-                        elif size_high > 0:
-                            return (size_high << 32) + size_low
-                    except pywintypes.error as e:
-                        print(f"GetFileSize error: {e}")
-                        # Try using SetFilePointer as alternative
+                handle = self._open_win32_handle()
+                try:
+                    length_info = win32file.DeviceIoControl(
+                        handle,
+                        IOCTL_DISK_GET_LENGTH_INFO,
+                        None,
+                        _LENGTH_INFO_STRUCT.size
+                    )
+                    size = _LENGTH_INFO_STRUCT.unpack_from(length_info)[0]
+                    if size > 0:
+                        return size
+                finally:
+                    win32file.CloseHandle(handle)
+            except Exception as e:
+                print(f"Method 1 (IOCTL length) failed: {e}")
+            
+            # Method 2: GetFileSize / SetFilePointer
+            try:
+                handle = self._open_win32_handle()
+                try:
+                    # For physical drives, use different approach
+                    if self.drive_path.startswith('\\\\.\\PhysicalDrive'):
+                        # Try to get partition info instead
                         try:
-                            win32file.SetFilePointer(handle, 0, win32file.FILE_END)
-                            size = win32file.SetFilePointer(handle, 0, win32file.FILE_CURRENT)
-                            if size > 0:
-                                return size
-                        except:
-                            pass
-                else:
-                    # For logical drives, standard method
-                    size_low, size_high = win32file.GetFileSize(handle)
-                    return (size_high << 32) + size_low
-            finally:
-                win32file.CloseHandle(handle)
-        except ImportError:
-            print("pywin32 not available")
-        except Exception as e:
-            print(f"Method 2 (pywin32) failed: {e}")
-        
-        # Method 3: Try Windows disk geometry API
-        try:
-            import win32file
-            handle = win32file.CreateFile(
-                self.drive_path,
-                win32file.GENERIC_READ,
-                win32file.FILE_SHARE_READ | win32file.FILE_SHARE_WRITE,
-                None,
-                win32file.OPEN_EXISTING,
-                0,
-                None
-            )
+                            size_low, size_high = win32file.GetFileSize(handle)
+                            if size_high == 0 and size_low > 0:
+                                return size_low
+                            elif size_high > 0:
+                                return (size_high << 32) + size_low
+                        except pywintypes.error as e:
+                            print(f"GetFileSize error: {e}")
+                            # Try using SetFilePointer as alternative
+                            try:
+                                win32file.SetFilePointer(handle, 0, win32file.FILE_END)
+                                size = win32file.SetFilePointer(handle, 0, win32file.FILE_CURRENT)
+                                if size > 0:
+                                    return size
+                            except:
+                                pass
+                    else:
+                        # For logical drives, standard method
+                        size_low, size_high = win32file.GetFileSize(handle)
+                        size = (size_high << 32) + size_low
+                        if size > 0:
+                            return size
+                finally:
+                    win32file.CloseHandle(handle)
+            except Exception as e:
+                print(f"Method 2 (pywin32) failed: {e}")
+            
+            # Method 3: Try Windows disk geometry API
             try:
+                handle = self._open_win32_handle()
                 try:
                     geometry = win32file.DeviceIoControl(
                         handle,
                         IOCTL_DISK_GET_DRIVE_GEOMETRY,
                         None,
-                        24  # Size of DISK_GEOMETRY structure
+                        _DISK_GEOMETRY_STRUCT.size
                     )
-                    if len(geometry) >= 24:
+                    if len(geometry) >= _DISK_GEOMETRY_STRUCT.size:
                         # Parse DISK_GEOMETRY structure
-                        cylinders, media_type, tracks_per_cylinder, sectors_per_track, bytes_per_sector = struct.unpack('<QLLLH', geometry)
+                        cylinders, media_type, tracks_per_cylinder, sectors_per_track, bytes_per_sector = _DISK_GEOMETRY_STRUCT.unpack_from(geometry)
                         total_size = cylinders * tracks_per_cylinder * sectors_per_track * bytes_per_sector
                         if total_size > 0:
                             return total_size
-                except:
-                    pass
-            finally:
-                win32file.CloseHandle(handle)
-        except:
-            pass
+                finally:
+                    win32file.CloseHandle(handle)
+            except:
+                pass
+        
+        # Method 4: Try shutil.disk_usage (mounted drives, filesystem size)
+        try:
+            drive_root = f"{self.drive_letter}:\\"
+            total, used, free = shutil.disk_usage(drive_root)
+            return total
+        except Exception as e:
+            print(f"Method 4 (shutil) failed: {e}")
         
-        # Method 4: Try direct file access
+        # Method 5: Try direct file access
         try:
             with open(self.drive_path, 'rb') as drive:
                 drive.seek(0, 2)  # Seek to end
                 return drive.tell()
         except Exception as e:
-            print(f"Method 4 (direct access) failed: {e}")
+            print(f"Method 5 (direct access) failed: {e}")
         
-        # Method 5: Estimate from drive info
+        # Method 6: Estimate from drive info
         try:
             statvfs = os.statvfs(f"{self.drive_letter}:\\")
             return statvfs.f_frsize * statvfs.f_blocks
@@ -158,10 +226,12 @@ def create_backup(file_path: str, data: bytes) -> bool:
 
 def hex_dump(data: bytes, start_offset: int = 0, max_bytes: int = 64) -> None:
     """Hiển thị hex dump của data"""
-    print(f"Hex dump (first {min(max_bytes, len(data))} bytes):")
+    lines = [f"Hex dump (first {min(max_bytes, len(data))} bytes):"]
     for i in range(0, min(max_bytes, len(data)), 16):
         offset = start_offset + i
         chunk = data[i:i+16]
         hex_str = ' '.join(f'{b:02X}' for b in chunk)
         ascii_str = ''.join(chr(b) if 32 <= b <= 126 else '.' for b in chunk)
-        print(f"{offset:04X}: {hex_str:<48} {ascii_str}")
+        lines.append(f"{offset:04X}: {hex_str:<48} {ascii_str}")
+    # Ghi toàn bộ một lần thay vì print từng dòng
+    print('\n'.join(lines))
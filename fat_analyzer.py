@@ -4,7 +4,8 @@ FAT Analysis and Recovery Module
 Module phân tích và khôi phục FAT
 """
 
-from typing import Dict, Optional
+from typing import Dict, Optional, Tuple
+from constants import BACKUP_BOOT_SECTORS, SECTOR_SIZE
 from disk_utils import DiskReader, create_backup
 from boot_sector import BootSectorParser, BootSectorValidator, BootSectorGenerator
 
@@ -17,6 +18,14 @@ class FATAnalyzer:
         self.disk_reader = DiskReader(drive_letter)
         self.current_boot_sector = None
         self.disk_size = 0
+    
+    def __enter__(self):
+        """Giữ một handle volume mở cho cả phân tích lẫn khôi phục"""
+        self.disk_reader.__enter__()
+        return self
+    
+    def __exit__(self, exc_type, exc_value, traceback):
+        return self.disk_reader.__exit__(exc_type, exc_value, traceback)
         
     def run_analysis(self) -> Dict:
         """Chạy phân tích toàn diện ổ đĩa"""
@@ -66,8 +75,7 @@ class FATAnalyzer:
                     print("✓ Boot sector hợp lệ")
                 else:
                     print(f"✗ Phát hiện {len(result['validation_errors'])} lỗi:")
-                    for i, error in enumerate(result['validation_errors'], 1):
-                        print(f"  {i}. {error}")
+                    print('\n'.join(f"  {i}. {error}" for i, error in enumerate(result['validation_errors'], 1)))
                     result['recovery_needed'] = True
             else:
                 # Boot sector bị hỏng nghiêm trọng, cần khôi phục
@@ -79,8 +87,8 @@ class FATAnalyzer:
         
         return result
     
-    def repair_boot_sector(self) -> bool:
-        """Sửa chữa boot sector bị hỏng"""
+    def repair_boot_sector(self, verify: bool = False) -> bool:
+        """Sửa chữa boot sector bị hỏng (verify=True để phân tích lại boot sector mới tạo)"""
         if self.current_boot_sector is None:
             print("Không có boot sector để sửa chữa")
             return False
@@ -88,34 +96,67 @@ class FATAnalyzer:
         print(f"\n=== SỬA CHỮA BOOT SECTOR ===")
         
         try:
-            # Tạo boot sector tối ưu
-            repaired_boot = BootSectorGenerator.generate_optimal_boot_sector(
-                self.current_boot_sector, self.disk_size
-            )
-            
-            # Kiểm tra boot sector mới
-            print("\nKiểm tra boot sector đã sửa chữa...")
-            repaired_info = BootSectorParser.parse_boot_sector(repaired_boot)
-            errors = BootSectorValidator.validate_boot_sector(repaired_info, self.disk_size)
-            
-            if errors:
-                print(f"Boot sector sửa chữa vẫn có lỗi:")
-                for error in errors:
-                    print(f"  - {error}")
-                return False
+            # Ưu tiên boot sector dự phòng hợp lệ, chỉ tạo mới khi không có
+            backup = self._find_backup_boot_sector()
+            if backup is not None:
+                # Bản dự phòng đã được phân tích và kiểm tra khi tìm, không kiểm tra lại
+                backup_sector, repaired_boot, repaired_info = backup
+                print(f"✓ Dùng boot sector dự phòng hợp lệ tại sector {backup_sector}")
             else:
-                print("✓ Boot sector sửa chữa hợp lệ!")
+                # Tạo boot sector tối ưu
+                repaired_boot, repaired_info = BootSectorGenerator.generate_optimal_boot_sector(
+                    self.current_boot_sector, self.disk_size
+                )
                 
-                # Hiển thị thông tin boot sector mới
-                self._display_boot_sector_info(repaired_info, "THÔNG TIN BOOT SECTOR ĐÃ SỬA CHỮA")
+                # Kiểm tra boot sector mới
+                print("\nKiểm tra boot sector đã sửa chữa...")
+                if verify:
+                    repaired_info = BootSectorParser.parse_boot_sector(repaired_boot)
+                errors = BootSectorValidator.validate_boot_sector(repaired_info, self.disk_size)
                 
-                # Lưu backup và ghi boot sector mới
-                return self._write_boot_sector(repaired_boot)
+                if errors:
+                    print(f"Boot sector sửa chữa vẫn có lỗi:")
+                    print('\n'.join(f"  - {error}" for error in errors))
+                    return False
+            
+            print("✓ Boot sector sửa chữa hợp lệ!")
+            
+            # Hiển thị thông tin boot sector mới
+            self._display_boot_sector_info(repaired_info, "THÔNG TIN BOOT SECTOR ĐÃ SỬA CHỮA")
+            
+            # Lưu backup và ghi boot sector mới
+            return self._write_boot_sector(repaired_boot)
                 
         except Exception as e:
             print(f"Lỗi khi sửa chữa boot sector: {str(e)}")
             return False
     
+    def _find_backup_boot_sector(self) -> Optional[Tuple[int, bytes, Dict]]:
+        """Tìm boot sector dự phòng hợp lệ, trả về (sector, boot sector, thông tin)"""
+        print("\nTìm boot sector dự phòng...")
+        first, last = min(BACKUP_BOOT_SECTORS), max(BACKUP_BOOT_SECTORS)
+        
+        # Đọc toàn bộ vùng chứa các vị trí dự phòng trong một lần
+        try:
+            region = self.disk_reader.read_sector(first, last - first + 1)
+        except Exception as e:
+            print(f"Không thể đọc vùng boot sector dự phòng: {str(e)}")
+            return None
+        
+        for sector in BACKUP_BOOT_SECTORS:
+            offset = (sector - first) * SECTOR_SIZE
+            data = region[offset:offset + SECTOR_SIZE]
+            # Loại nhanh dữ liệu rác, không dùng exception cho luồng điều khiển
+            if not BootSectorParser.looks_like_boot_sector(data):
+                continue
+            
+            info = BootSectorParser.parse_boot_sector(data)
+            if not BootSectorValidator.validate_boot_sector(info, self.disk_size):
+                return sector, data, info
+        
+        print("Không tìm thấy boot sector dự phòng hợp lệ")
+        return None
+    
     def _write_boot_sector(self, new_boot_sector: bytes) -> bool:
         """Ghi boot sector mới vào đĩa"""
         print(f"\n=== GHI BOOT SECTOR MỚI ===")
@@ -127,6 +168,13 @@ class FATAnalyzer:
         
         print(f"✓ Đã tạo backup tại: {backup_path}")
         
+        # Lưu boot sector mới ra file một lần, trước khi ghi vào đĩa, để vẫn
+        # có thể áp dụng thủ công nếu ghi trực tiếp thất bại
+        recovered_path = f"{self.drive_letter}_boot_recovered.bin"
+        recovered_saved = create_backup(recovered_path, new_boot_sector)
+        if recovered_saved:
+            print(f"✓ Đã lưu boot sector mới tại: {recovered_path}")
+        
         # Xác nhận từ người dùng
         print(f"\n⚠ CẢNH BÁO: Bạn sắp ghi đè boot sector của ổ đĩa {self.drive_letter}:")
         print("Thao tác này có thể làm hỏng dữ liệu nếu không thực hiện đúng!")
@@ -147,6 +195,8 @@ class FATAnalyzer:
         except Exception as e:
             print(f"✗ Lỗi khi ghi boot sector: {str(e)}")
             print("Có thể do quyền truy cập hoặc ổ đĩa được bảo vệ")
+            if recovered_saved:
+                print(f"Boot sector mới vẫn được lưu tại: {recovered_path}")
             return False
     
     def _display_boot_sector_info(self, info: Dict, title: str) -> None:
@@ -8,8 +8,46 @@ import struct
 import os
 import sys
 import argparse
+from collections import namedtuple
 from typing import Dict, List, Tuple, Optional
 import math
+import shutil
+
+# pywin32 là tùy chọn (chỉ có trên Windows)
+try:
+    import win32file
+    import pywintypes
+except ImportError:
+    win32file = None
+    pywintypes = None
+
+# Các instance struct.Struct là hằng số cấp module, dùng chung cho mọi lần
+# phân tích - không tạo lại trong hàm.
+# BPB chung FAT12/16/32: offset 11..36
+_BPB_STRUCT = struct.Struct('<HBHBHHBHHHII')
+BPBFields = namedtuple('BPBFields', [
+    'bytes_per_sector', 'sectors_per_cluster', 'reserved_sectors', 'num_fats',
+    'root_entries', 'total_sectors_16', 'media_descriptor', 'sectors_per_fat_16',
+    'sectors_per_track', 'num_heads', 'hidden_sectors', 'total_sectors_32',
+])
+# Phần BPB mở rộng của FAT32: offset 36..52
+_FAT32_EXT_STRUCT = struct.Struct('<IHHIHH')
+# GET_LENGTH_INFORMATION: LARGE_INTEGER Length
+_LENGTH_INFO_STRUCT = struct.Struct('<q')
+# DISK_GEOMETRY: Cylinders, MediaType, TracksPerCylinder, SectorsPerTrack, BytesPerSector
+_DISK_GEOMETRY_STRUCT = struct.Struct('<qIIII')
+
+# Windows disk IOCTL codes
+IOCTL_DISK_GET_DRIVE_GEOMETRY = 0x00070000
+IOCTL_DISK_GET_LENGTH_INFO = 0x0007405C
+
+# Cache kích thước ổ đĩa theo chữ cái ổ đĩa
+_disk_size_cache = {}
+
+
+def _unpack_bpb(boot_data: bytes) -> BPBFields:
+    """Giải mã toàn bộ BPB chung (offset 11..36) trong một lần unpack"""
+    return BPBFields._make(_BPB_STRUCT.unpack_from(boot_data, 11))
 
 
 class FATAnalyzer:
@@ -31,107 +69,126 @@ class FATAnalyzer:
             raise Exception(f"Không thể đọc sector {sector_num}: {str(e)}")
     
     def get_disk_size(self) -> int:
+        """Lấy kích thước ổ đĩa (có cache theo ổ đĩa)"""
+        if self.drive_letter not in _disk_size_cache:
+            size = self._query_disk_size()
+            if size == 0:
+                # Không cache kết quả thất bại để lần sau thử lại
+                return 0
+            _disk_size_cache[self.drive_letter] = size
+        return _disk_size_cache[self.drive_letter]
+    
+    def _open_win32_handle(self):
+        """Mở handle pywin32 tới volume (chỉ đọc)"""
+        return win32file.CreateFile(
+            self.drive_path,
+            win32file.GENERIC_READ,
+            win32file.FILE_SHARE_READ | win32file.FILE_SHARE_WRITE,
+            None,
+            win32file.OPEN_EXISTING,
+            0,
+            None
+        )
+    
+    def _query_disk_size(self) -> int:
         """Lấy kích thước ổ đĩa với multiple fallback methods"""
         
-        # Method 1: Try shutil.disk_usage (most reliable for mounted drives)
-        try:
-            import shutil
-            drive_root = f"{self.drive_letter}:\\"
-            total, used, free = shutil.disk_usage(drive_root)
-            return total
-        except Exception as e:
-            print(f"Method 1 (shutil) failed: {e}")
-        
-        # Method 2: Try pywin32 if available
-        try:
-            import win32file
-            import pywintypes
-            handle = win32file.CreateFile(
-                self.drive_path,
-                win32file.GENERIC_READ,
-                win32file.FILE_SHARE_READ | win32file.FILE_SHARE_WRITE,
-                None,
-                win32file.OPEN_EXISTING,
-                0,
-                None
-            )
+        # Method 1-3 cần pywin32
+        if win32file is None:
+            print("pywin32 not available")
+        else:
+            # Method 1: IOCTL_DISK_GET_LENGTH_INFO - kích thước thật của volume thô,
+            # không cần filesystem hợp lệ và không đọc dữ liệu
             try:
-                # For physical drives, use different approach
-                if self.drive_path.startswith('\\\\.\\PhysicalDrive'):
-                    # Try to get partition info instead
-                    try:
-                        size_low, size_high = win32file.GetFileSize(handle)
-                        if size_high == 0 and size_low > 0:
-                            return size_low
-                        elif size_high > 0:
-                            return (size_high << 32) + size_low
-                    except pywintypes.error as e:
-                        print(f"GetFileSize error: {e}")
-                        # Try using SetFilePointer as alternative
+                handle = self._open_win32_handle()
+                try:
+                    length_info = win32file.DeviceIoControl(
+                        handle,
+                        IOCTL_DISK_GET_LENGTH_INFO,
+                        None,
+                        _LENGTH_INFO_STRUCT.size
+                    )
+                    size = _LENGTH_INFO_STRUCT.unpack_from(length_info)[0]
+                    if size > 0:
+                        return size
+                finally:
+                    win32file.CloseHandle(handle)
+            except Exception as e:
+                print(f"Method 1 (IOCTL length) failed: {e}")
+            
+            # Method 2: GetFileSize / SetFilePointer
+            try:
+                handle = self._open_win32_handle()
+                try:
+                    # For physical drives, use different approach
+                    if self.drive_path.startswith('\\\\.\\PhysicalDrive'):
+                        # Try to get partition info instead
                         try:
-                            win32file.SetFilePointer(handle, 0, win32file.FILE_END)
-                            size = win32file.SetFilePointer(handle, 0, win32file.FILE_CURRENT)
-                            if size > 0:
-                                return size
-                        except:
-                            pass
-                else:
-                    # For logical drives, standard method
-                    size_low, size_high = win32file.GetFileSize(handle)
-                    return (size_high << 32) + size_low
-            finally:
-                win32file.CloseHandle(handle)
-        except ImportError:
-            print("pywin32 not available")
-        except Exception as e:
-            print(f"Method 2 (pywin32) failed: {e}")
-        
-        # Method 3: Try Windows disk geometry API
-        try:
-            import win32file
-            import struct
-            handle = win32file.CreateFile(
-                self.drive_path,
-                win32file.GENERIC_READ,
-                win32file.FILE_SHARE_READ | win32file.FILE_SHARE_WRITE,
-                None,
-                win32file.OPEN_EXISTING,
-                0,
-                None
-            )
+                            size_low, size_high = win32file.GetFileSize(handle)
+                            if size_high == 0 and size_low > 0:
+                                return size_low
+                            elif size_high > 0:
+                                return (size_high << 32) + size_low
+                        except pywintypes.error as e:
+                            print(f"GetFileSize error: {e}")
+                            # Try using SetFilePointer as alternative
+                            try:
+                                win32file.SetFilePointer(handle, 0, win32file.FILE_END)
+                                size = win32file.SetFilePointer(handle, 0, win32file.FILE_CURRENT)
+                                if size > 0:
+                                    return size
+                            except:
+                                pass
+                    else:
+                        # For logical drives, standard method
+                        size_low, size_high = win32file.GetFileSize(handle)
+                        size = (size_high << 32) + size_low
+                        if size > 0:
+                            return size
+                finally:
+                    win32file.CloseHandle(handle)
+            except Exception as e:
+                print(f"Method 2 (pywin32) failed: {e}")
+            
+            # Method 3: Try Windows disk geometry API
             try:
-                # IOCTL_DISK_GET_DRIVE_GEOMETRY
-                IOCTL_DISK_GET_DRIVE_GEOMETRY = 0x00070000
+                handle = self._open_win32_handle()
                 try:
                     geometry = win32file.DeviceIoControl(
                         handle,
                         IOCTL_DISK_GET_DRIVE_GEOMETRY,
                         None,
-                        24  # Size of DISK_GEOMETRY structure
+                        _DISK_GEOMETRY_STRUCT.size
                     )
-                    if len(geometry) >= 24:
+                    if len(geometry) >= _DISK_GEOMETRY_STRUCT.size:
                         # Parse DISK_GEOMETRY structure
-                        cylinders, media_type, tracks_per_cylinder, sectors_per_track, bytes_per_sector = struct.unpack('<QLLLH', geometry)
+                        cylinders, media_type, tracks_per_cylinder, sectors_per_track, bytes_per_sector = _DISK_GEOMETRY_STRUCT.unpack_from(geometry)
                         total_size = cylinders * tracks_per_cylinder * sectors_per_track * bytes_per_sector
                         if total_size > 0:
                             return total_size
-                except:
-                    pass
-            finally:
-                win32file.CloseHandle(handle)
-        except:
-            pass
+                finally:
+                    win32file.CloseHandle(handle)
+            except:
+                pass
         
-        # Method 4: Try direct file access
+        # Method 4: Try shutil.disk_usage (mounted drives, filesystem size)
+        try:
+            drive_root = f"{self.drive_letter}:\\"
+            total, used, free = shutil.disk_usage(drive_root)
+            return total
+        except Exception as e:
+            print(f"Method 4 (shutil) failed: {e}")
+        
+        # Method 5: Try direct file access
         try:
             with open(self.drive_path, 'rb') as drive:
                 drive.seek(0, 2)  # Seek to end
                 return drive.tell()
         except Exception as e:
-            print(f"Method 4 (direct access) failed: {e}")
-          # Method 5: Estimate from drive info
+            print(f"Method 5 (direct access) failed: {e}")
+        
+        # Method 6: Estimate from drive info
         try:
-            import os
             statvfs = os.statvfs(f"{self.drive_letter}:\\")
             return statvfs.f_frsize * statvfs.f_blocks
         except:
@@ -146,11 +203,14 @@ class FATAnalyzer:
             raise ValueError("Boot sector không đủ 512 bytes")
         
         # Hiển thị hex dump đầu tiên của boot sector để debug
-        print(f"Boot sector hex dump (first 64 bytes):")
+        lines = ["Boot sector hex dump (first 64 bytes):"]
         for i in range(0, min(64, len(boot_data)), 16):
-            hex_str = ' '.join(f'{b:02X}' for b in boot_data[i:i+16])
-            ascii_str = ''.join(chr(b) if 32 <= b <= 126 else '.' for b in boot_data[i:i+16])
-            print(f"{i:04X}: {hex_str:<48} {ascii_str}")
+            chunk = boot_data[i:i+16]
+            hex_str = ' '.join(f'{b:02X}' for b in chunk)
+            ascii_str = ''.join(chr(b) if 32 <= b <= 126 else '.' for b in chunk)
+            lines.append(f"{i:04X}: {hex_str:<48} {ascii_str}")
+        # Ghi toàn bộ một lần thay vì print từng dòng
+        print('\n'.join(lines))
         
         # Kiểm tra chữ ký boot sector
         if boot_data[510:512] != b'\x55\xAA':
@@ -158,53 +218,44 @@ class FATAnalyzer:
             # Không raise exception, tiếp tục phân tích
         
         # Trích xuất thông tin cơ bản với error handling
-        info = {}
         try:
-            info['oem_name'] = boot_data[3:11].decode('ascii', errors='ignore').strip()
-            info['bytes_per_sector'] = struct.unpack('<H', boot_data[11:13])[0]
-            info['sectors_per_cluster'] = boot_data[13]
-            info['reserved_sectors'] = struct.unpack('<H', boot_data[14:16])[0]
-            info['num_fats'] = boot_data[16]
-            info['root_entries'] = struct.unpack('<H', boot_data[17:19])[0]
-            info['total_sectors_16'] = struct.unpack('<H', boot_data[19:21])[0]
-            info['media_descriptor'] = boot_data[21]
-            info['sectors_per_fat_16'] = struct.unpack('<H', boot_data[22:24])[0]
-            info['sectors_per_track'] = struct.unpack('<H', boot_data[24:26])[0]
-            info['num_heads'] = struct.unpack('<H', boot_data[26:28])[0]
-            info['hidden_sectors'] = struct.unpack('<I', boot_data[28:32])[0]
-            info['total_sectors_32'] = struct.unpack('<I', boot_data[32:36])[0]
+            oem_name = bytes(boot_data[3:11]).decode('ascii', errors='ignore').strip()
+            bpb = _unpack_bpb(boot_data)
             
             # Debug: hiển thị các giá trị quan trọng
             print(f"Debug values:")
-            print(f"  bytes_per_sector: {info['bytes_per_sector']}")
-            print(f"  sectors_per_cluster: {info['sectors_per_cluster']}")
-            print(f"  total_sectors_16: {info['total_sectors_16']}")
-            print(f"  total_sectors_32: {info['total_sectors_32']}")
+            print(f"  bytes_per_sector: {bpb.bytes_per_sector}")
+            print(f"  sectors_per_cluster: {bpb.sectors_per_cluster}")
+            print(f"  total_sectors_16: {bpb.total_sectors_16}")
+            print(f"  total_sectors_32: {bpb.total_sectors_32}")
             
             # Kiểm tra giá trị 0 trước khi tính toán
-            if info['bytes_per_sector'] == 0:
+            if bpb.bytes_per_sector == 0:
                 raise ValueError("bytes_per_sector = 0, boot sector bị hỏng")
-            if info['sectors_per_cluster'] == 0:
+            if bpb.sectors_per_cluster == 0:
                 raise ValueError("sectors_per_cluster = 0, boot sector bị hỏng")
-            
-            # Xác định tổng số sector
-            info['total_sectors'] = info['total_sectors_32'] if info['total_sectors_16'] == 0 else info['total_sectors_16']
-            
-            if info['total_sectors'] == 0:
+            if (bpb.total_sectors_16 or bpb.total_sectors_32) == 0:
                 raise ValueError("total_sectors = 0, boot sector bị hỏng")
                 
         except Exception as e:
             raise ValueError(f"Lỗi khi phân tích boot sector: {str(e)}")
         
+        return self._info_from_bpb(oem_name, bpb, boot_data)
+    
+    def _info_from_bpb(self, oem_name: str, bpb: BPBFields, boot_data: bytes) -> Dict:
+        """Tính thông tin boot sector từ BPB đã giải mã (dùng chung cho parser và generator)"""
+        info = {'oem_name': oem_name}
+        info.update(bpb._asdict())
+        
+        # Xác định tổng số sector
+        # Theo chuẩn FAT chỉ một trong hai trường khác 0
+        info['total_sectors'] = bpb.total_sectors_16 or bpb.total_sectors_32
+        
         # Phân tích thêm cho FAT32
         if info['sectors_per_fat_16'] == 0:
             # FAT32
-            info['sectors_per_fat'] = struct.unpack('<I', boot_data[36:40])[0]
-            info['ext_flags'] = struct.unpack('<H', boot_data[40:42])[0]
-            info['fs_version'] = struct.unpack('<H', boot_data[42:44])[0]
-            info['root_cluster'] = struct.unpack('<I', boot_data[44:48])[0]
-            info['fs_info'] = struct.unpack('<H', boot_data[48:50])[0]
-            info['backup_boot_sec'] = struct.unpack('<H', boot_data[50:52])[0]
+            (info['sectors_per_fat'], info['ext_flags'], info['fs_version'],
+             info['root_cluster'], info['fs_info'], info['backup_boot_sec']) = _FAT32_EXT_STRUCT.unpack_from(boot_data, 36)
             info['fat_type'] = 32
         else:
             # FAT12/FAT16
@@ -333,8 +384,7 @@ class FATAnalyzer:
                     print("✓ Boot sector hợp lệ")
                 else:
                     print(f"✗ Phát hiện {len(result['validation_errors'])} lỗi:")
-                    for i, error in enumerate(result['validation_errors'], 1):
-                        print(f"  {i}. {error}")
+                    print('\n'.join(f"  {i}. {error}" for i, error in enumerate(result['validation_errors'], 1)))
                     result['recovery_needed'] = True
             else:
                 # Boot sector bị hỏng nghiêm trọng, cần khôi phục
@@ -346,17 +396,17 @@ class FATAnalyzer:
         
         return result
 
-    def generate_optimal_boot_sector(self, damaged_boot: bytes) -> bytes:
-        """Tạo boot sector tối ưu dựa trên thông tin có sẵn và kích thước đĩa"""
+    def generate_optimal_boot_sector(self, damaged_boot: bytes) -> Tuple[bytes, Dict]:
+        """Tạo boot sector tối ưu, trả về (boot sector mới, thông tin boot sector mới)"""
         print("\n=== TẠO BOOT SECTOR TỐI ƯU ===")
         
         # Bắt đầu với boot sector bị hỏng
         new_boot = bytearray(damaged_boot)
         
         # Lấy thông tin có thể tin cậy từ boot sector cũ
-        total_sectors_16 = struct.unpack('<H', damaged_boot[19:21])[0]
-        total_sectors_32 = struct.unpack('<I', damaged_boot[32:36])[0]
-        total_sectors = total_sectors_32 if total_sectors_16 == 0 else total_sectors_16
+        bpb = _unpack_bpb(damaged_boot)
+        # Theo chuẩn FAT chỉ một trong hai trường khác 0
+        total_sectors = bpb.total_sectors_16 or bpb.total_sectors_32
         
         print(f"Phát hiện tổng sectors từ boot sector: {total_sectors}")
         
@@ -388,20 +438,20 @@ class FATAnalyzer:
         
         # Xác định FAT type dựa trên data clusters
         temp_clusters = data_sectors // sectors_per_cluster
+        # Tính dung lượng FAT bằng số nguyên
+        max_clusters = temp_clusters
         if temp_clusters < 4085:
-            # FAT12 - 1.5 bytes per entry
-            fat_entry_size = 1.5
+            # FAT12 - 1.5 bytes per entry (2 entry trong 3 bytes), làm tròn lên
+            fat_size_bytes = (max_clusters * 3 + 1) // 2
         else:
-            # FAT16 - 2 bytes per entry  
-            fat_entry_size = 2
+            # FAT16 - 2 bytes per entry
+            fat_size_bytes = max_clusters * 2
         
         # Tính sectors per FAT
         # Số clusters tối đa = data_sectors / sectors_per_cluster
         # Dung lượng FAT = clusters * fat_entry_size
         # sectors_per_fat = ceil(dung_lượng_FAT / bytes_per_sector)
-        max_clusters = temp_clusters
-        fat_size_bytes = max_clusters * fat_entry_size
-        sectors_per_fat = int((fat_size_bytes + bytes_per_sector - 1) // bytes_per_sector)
+        sectors_per_fat = (fat_size_bytes + bytes_per_sector - 1) // bytes_per_sector
         
         # Kiểm tra và điều chỉnh
         if sectors_per_fat > data_sectors // 4:  # Không nên quá 25% data sectors
@@ -420,30 +470,37 @@ class FATAnalyzer:
         print(f"  Sectors per FAT: {sectors_per_fat}")
         print(f"  Total sectors: {total_sectors}")
         
-        # Ghi các giá trị vào boot sector mới
-        struct.pack_into('<H', new_boot, 11, bytes_per_sector)  # bytes per sector
-        new_boot[13] = sectors_per_cluster  # sectors per cluster
-        struct.pack_into('<H', new_boot, 14, reserved_sectors)  # reserved sectors
-        new_boot[16] = num_fats  # number of FATs
-        struct.pack_into('<H', new_boot, 17, root_entries)  # root entries
-        
+        # Ghi các giá trị vào boot sector mới trong một lần pack (offset 11..36);
+        # sectors per track, số head và hidden sectors giữ nguyên từ boot sector cũ
         if total_sectors < 65536:
-            struct.pack_into('<H', new_boot, 19, total_sectors)  # total sectors 16
-            struct.pack_into('<I', new_boot, 32, 0)  # total sectors 32
+            total_sectors_16, total_sectors_32 = total_sectors, 0
         else:
-            struct.pack_into('<H', new_boot, 19, 0)  # total sectors 16
-            struct.pack_into('<I', new_boot, 32, total_sectors)  # total sectors 32
-        
-        new_boot[21] = media_descriptor  # media descriptor
-        struct.pack_into('<H', new_boot, 22, sectors_per_fat)  # sectors per FAT
+            total_sectors_16, total_sectors_32 = 0, total_sectors
+        
+        new_bpb = bpb._replace(
+            bytes_per_sector=bytes_per_sector,
+            sectors_per_cluster=sectors_per_cluster,
+            reserved_sectors=reserved_sectors,
+            num_fats=num_fats,
+            root_entries=root_entries,
+            total_sectors_16=total_sectors_16,
+            media_descriptor=media_descriptor,
+            sectors_per_fat_16=sectors_per_fat,
+            total_sectors_32=total_sectors_32,
+        )
+        _BPB_STRUCT.pack_into(new_boot, 11, *new_bpb)
         
         # Cập nhật boot signature nếu cần
         new_boot[510:512] = b'\x55\xAA'
         
-        return bytes(new_boot)
+        # Thông tin boot sector mới, tính qua cùng đường với parse_boot_sector
+        oem_name = bytes(damaged_boot[3:11]).decode('ascii', errors='ignore').strip()
+        info = self._info_from_bpb(oem_name, new_bpb, new_boot)
+        
+        return bytes(new_boot), info
     
-    def repair_boot_sector(self) -> bool:
-        """Sửa chữa boot sector bị hỏng"""
+    def repair_boot_sector(self, verify: bool = False) -> bool:
+        """Sửa chữa boot sector bị hỏng (verify=True để phân tích lại boot sector mới)"""
         if self.current_boot_sector is None:
             print("Không có boot sector để sửa chữa")
             return False
@@ -452,17 +509,17 @@ class FATAnalyzer:
         
         try:
             # Tạo boot sector tối ưu
-            repaired_boot = self.generate_optimal_boot_sector(self.current_boot_sector)
+            repaired_boot, repaired_info = self.generate_optimal_boot_sector(self.current_boot_sector)
             
             # Kiểm tra boot sector mới
             print("\nKiểm tra boot sector đã sửa chữa...")
-            repaired_info = self.parse_boot_sector(repaired_boot)
+            if verify:
+                repaired_info = self.parse_boot_sector(repaired_boot)
             errors = self.validate_boot_sector(repaired_info)
             
             if errors:
                 print(f"Boot sector sửa chữa vẫn có lỗi:")
-                for error in errors:
-                    print(f"  - {error}")
+                print('\n'.join(f"  - {error}" for error in errors))
                 return False
             else:
                 print("✓ Boot sector sửa chữa hợp lệ!")
@@ -530,9 +587,6 @@ class FATAnalyzer:
     # ...existing code...
 def main():
     """Hàm main để chạy công cụ phân tích FAT"""
-    import argparse
-    import sys
-    
     parser = argparse.ArgumentParser(
         description="FAT Data Recovery Tool - Công cụ phân tích và khôi phục boot sector",
         formatter_class=argparse.RawDescriptionHelpFormatter,
@@ -549,6 +603,8 @@ Ví dụ sử dụng:
                        help='Thực hiện khôi phục tương tác nếu phát hiện lỗi')
     parser.add_argument('--info-only', action='store_true',
                        help='Chỉ hiển thị thông tin phân tích, không khôi phục')
+    parser.add_argument('--verify', action='store_true',
+                       help='Phân tích lại boot sector sau khi sửa chữa để kiểm tra')
     
     args = parser.parse_args()
     
@@ -570,7 +626,7 @@ Ví dụ sử dụng:
                     print("⚠ Phát hiện vấn đề với boot sector")
                     if args.recovery and not args.info_only:
                         print("\nThực hiện khôi phục boot sector...")
-                        if analyzer.repair_boot_sector():
+                        if analyzer.repair_boot_sector(verify=args.verify):
                             print("✓ Khôi phục thành công!")
                         else:
                             print("✗ Khôi phục thất bại")
@@ -582,7 +638,7 @@ Ví dụ sử dụng:
                 print("✗ Boot sector bị hỏng nghiêm trọng")
                 if args.recovery and not args.info_only:
                     print("\nThực hiện khôi phục boot sector bị hỏng...")
-                    if analyzer.repair_boot_sector():
+                    if analyzer.repair_boot_sector(verify=args.verify):
                         print("✓ Khôi phục thành công!")
                     else:
                         print("✗ Khôi phục thất bại")
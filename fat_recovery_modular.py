@@ -10,13 +10,7 @@ Sử dụng:
 """
 
 import sys
-from cli import FATRecoveryCLI
-
-
-def main():
-    """Hàm main để chạy công cụ phân tích FAT"""
-    cli = FATRecoveryCLI()
-    return cli.run()
+from main import main
 
 
 if __name__ == "__main__":
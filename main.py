@@ -4,14 +4,25 @@ FAT Recovery Tool - Main Entry Point
 Công cụ khôi phục FAT - Điểm vào chính
 """
 
+import os
 import sys
-from cli import FATRecoveryCLI
+from constants import CLI_HELP
+
+
+def _print_quick_help() -> None:
+    """Hiển thị help mà không cần nạp module cli"""
+    print(CLI_HELP.format(prog=os.path.basename(sys.argv[0])))
 
 
 def main():
     """Hàm main để chạy công cụ phân tích FAT"""
-    cli = FATRecoveryCLI()
-    return cli.run()
+    # Trả về help sớm để không phải import cli (và các module phụ thuộc)
+    if '--help' in sys.argv or '-h' in sys.argv:
+        _print_quick_help()
+        return 0
+
+    from cli import FATRecoveryCLI
+    return FATRecoveryCLI().run()
 
 
 if __name__ == "__main__":
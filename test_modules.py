@@ -6,6 +6,11 @@ Test đơn vị cho các module của công cụ khôi phục FAT
 
 import unittest
 import struct
+import io
+import contextlib
+import tempfile
+from types import MappingProxyType
+from unittest import mock
 import sys
 import os
 
@@ -14,7 +19,19 @@ sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
 
 from constants import *
 from boot_sector import BootSectorParser, BootSectorValidator, BootSectorGenerator
-from disk_utils import hex_dump, create_backup
+from disk_utils import DiskReader, hex_dump, create_backup
+from fat_analyzer import FATAnalyzer
+from cli import FATRecoveryCLI
+
+# Shared Structs for building and reading BPB fields in tests
+_U16 = struct.Struct('<H')
+_U32 = struct.Struct('<I')
+# BPB offset 11..24: bps, spc, reserved, num fats, root entries, total 16, media, spf
+_BPB = struct.Struct('<HBHBHHBH')
+# OEM name of the FAT12 template boot sector
+_OEM = b'TESTFAT '
+# Damaged boot sector with only total sectors 16 = 40960 set (immutable, shared)
+_DAMAGED_BOOT = bytes(19) + _U16.pack(40960) + bytes(491)
 
 
 class TestConstants(unittest.TestCase):
@@ -41,24 +58,34 @@ class TestConstants(unittest.TestCase):
 class TestBootSectorParser(unittest.TestCase):
     """Test boot sector parser"""
     
+    parse = staticmethod(BootSectorParser.parse_boot_sector)
+    looks_like = staticmethod(BootSectorParser.looks_like_boot_sector)
+    
+    @classmethod
+    def setUpClass(cls):
+        """Build the valid boot sector template once per class"""
+        # Create a valid FAT12 boot sector
+        buf = bytearray(512)
+        buf[3:11] = _OEM
+        _BPB.pack_into(buf, 11,
+                       512,    # bytes per sector
+                       1,      # sectors per cluster
+                       1,      # reserved sectors
+                       2,      # num fats
+                       512,    # root entries
+                       40960,  # total sectors 16
+                       0xF8,   # media descriptor
+                       159)    # sectors per fat
+        buf[510:512] = BOOT_SIGNATURE
+        cls._TEMPLATE = bytes(buf)
+    
     def setUp(self):
         """Set up test data"""
-        # Create a valid FAT12 boot sector
-        self.valid_boot = bytearray(512)
-        self.valid_boot[3:11] = b'TESTFAT '
-        self.valid_boot[11:13] = struct.pack('<H', 512)  # bytes per sector
-        self.valid_boot[13] = 1  # sectors per cluster
-        self.valid_boot[14:16] = struct.pack('<H', 1)  # reserved sectors
-        self.valid_boot[16] = 2  # num fats
-        self.valid_boot[17:19] = struct.pack('<H', 512)  # root entries
-        self.valid_boot[19:21] = struct.pack('<H', 40960)  # total sectors 16
-        self.valid_boot[21] = 0xF8  # media descriptor
-        self.valid_boot[22:24] = struct.pack('<H', 159)  # sectors per fat
-        self.valid_boot[510:512] = BOOT_SIGNATURE
+        self.valid_boot = bytearray(self._TEMPLATE)
     
     def test_parse_valid_boot_sector(self):
         """Test parsing valid boot sector"""
-        info = BootSectorParser.parse_boot_sector(bytes(self.valid_boot))
+        info = self.parse(memoryview(self.valid_boot))
         
         self.assertEqual(info['oem_name'], 'TESTFAT')
         self.assertEqual(info['bytes_per_sector'], 512)
@@ -70,66 +97,89 @@ class TestBootSectorParser(unittest.TestCase):
     def test_parse_invalid_boot_sector(self):
         """Test parsing invalid boot sector"""
         # Test with too short data
-        with self.assertRaises(ValueError):
-            BootSectorParser.parse_boot_sector(b'\x00' * 100)
+        with self.assertRaisesRegex(ValueError, r'512 bytes'):
+            self.parse(b'\x00' * 100)
         
         # Test with zero bytes per sector
         invalid_boot = bytearray(self.valid_boot)
-        invalid_boot[11:13] = struct.pack('<H', 0)
+        _U16.pack_into(invalid_boot, 11, 0)
         
-        with self.assertRaises(ValueError):
-            BootSectorParser.parse_boot_sector(bytes(invalid_boot))
+        with self.assertRaisesRegex(ValueError, r'bytes_per_sector = 0'):
+            self.parse(memoryview(invalid_boot))
+    
+    def test_looks_like_boot_sector(self):
+        """Test quick boot sector check rejects garbage without raising"""
+        self.assertTrue(self.looks_like(memoryview(self.valid_boot)))
+        self.assertFalse(self.looks_like(b'\x00' * 100))
+        self.assertFalse(self.looks_like(b'\x00' * 512))
+        
+        invalid_boot = bytearray(self.valid_boot)
+        _U16.pack_into(invalid_boot, 11, 0)
+        self.assertFalse(self.looks_like(memoryview(invalid_boot)))
     
     def test_determine_fat_type(self):
         """Test FAT type determination"""
         # Test data with different cluster counts
-        test_cases = [
-            ({'total_clusters': 1000}, 12),
-            ({'total_clusters': 10000}, 16),
-            ({'total_clusters': 100000}, 32)
-        ]
-        
-        for info, expected_type in test_cases:
-            result = BootSectorParser._determine_fat_type(info)
-            self.assertEqual(result, expected_type)
+        determine = BootSectorParser._determine_fat_type
+        for clusters, expected_type in ((1000, 12), (10000, 16), (100000, 32)):
+            with self.subTest(total_clusters=clusters):
+                self.assertEqual(determine({'total_clusters': clusters}), expected_type)
+    
+    def test_determine_fat_type_boundaries(self):
+        """Test FAT type at the cluster count thresholds"""
+        determine = BootSectorParser._determine_fat_type
+        boundaries = (
+            (1, 12),
+            (FAT12_MAX_CLUSTERS - 1, 12),
+            (FAT12_MAX_CLUSTERS, 16),
+            (FAT12_MAX_CLUSTERS + 1, 16),
+            (FAT16_MAX_CLUSTERS - 1, 16),
+            (FAT16_MAX_CLUSTERS, 32),
+            (FAT16_MAX_CLUSTERS + 1, 32),
+            (10**6, 32),
+        )
+        for clusters, expected_type in boundaries:
+            with self.subTest(total_clusters=clusters):
+                self.assertEqual(determine({'total_clusters': clusters}), expected_type)
 
 
 class TestBootSectorValidator(unittest.TestCase):
     """Test boot sector validator"""
     
-    def setUp(self):
-        """Set up test data"""
-        self.valid_info = {
-            'bytes_per_sector': 512,
-            'sectors_per_cluster': 1,
-            'num_fats': 2,
-            'reserved_sectors': 1,
-            'fat_type': 12,
-            'root_entries': 512,
-            'media_descriptor': 0xF8,
-            'total_sectors': 40960
-        }
+    validate = staticmethod(BootSectorValidator.validate_boot_sector)
+    check = staticmethod(BootSectorValidator.check_boot_sector)
+    
+    # Shared read-only fixture; tests build a new dict when they change a field
+    _BASE_INFO = MappingProxyType({
+        'bytes_per_sector': 512,
+        'sectors_per_cluster': 1,
+        'num_fats': 2,
+        'reserved_sectors': 1,
+        'fat_type': 12,
+        'root_entries': 512,
+        'media_descriptor': 0xF8,
+        'total_sectors': 40960
+    })
     
     def test_validate_valid_boot_sector(self):
         """Test validation of valid boot sector"""
-        errors = BootSectorValidator.validate_boot_sector(self.valid_info)
+        errors = self.validate(self._BASE_INFO)
         self.assertEqual(len(errors), 0)
     
     def test_validate_invalid_bytes_per_sector(self):
         """Test validation with invalid bytes per sector"""
-        invalid_info = self.valid_info.copy()
-        invalid_info['bytes_per_sector'] = 1000  # Invalid value
+        invalid_info = {**self._BASE_INFO, 'bytes_per_sector': 1000}  # Invalid value
         
-        errors = BootSectorValidator.validate_boot_sector(invalid_info)
-        self.assertTrue(any('Bytes per sector' in error for error in errors))
+        errors = self.check(invalid_info)
+        self.assertIn('bytes_per_sector', {tag for tag, _ in errors})
+        self.assertRegex('\n'.join(self.validate(invalid_info)), r'Bytes per sector')
     
     def test_validate_invalid_sectors_per_cluster(self):
         """Test validation with invalid sectors per cluster"""
-        invalid_info = self.valid_info.copy()
-        invalid_info['sectors_per_cluster'] = 3  # Invalid value
+        invalid_info = {**self._BASE_INFO, 'sectors_per_cluster': 3}  # Invalid value
         
-        errors = BootSectorValidator.validate_boot_sector(invalid_info)
-        self.assertTrue(any('Sectors per cluster' in error for error in errors))
+        errors = self.check(invalid_info)
+        self.assertEqual({tag for tag, _ in errors}, {'sectors_per_cluster'})
 
 
 class TestBootSectorGenerator(unittest.TestCase):
@@ -137,24 +187,131 @@ class TestBootSectorGenerator(unittest.TestCase):
     
     def test_generate_optimal_boot_sector(self):
         """Test generating optimal boot sector"""
-        # Create damaged boot sector
-        damaged_boot = bytearray(512)
-        damaged_boot[19:21] = struct.pack('<H', 40960)  # total sectors
-        
         # Generate optimal boot sector
-        optimal_boot = BootSectorGenerator.generate_optimal_boot_sector(
-            bytes(damaged_boot), disk_size=20*1024*1024
+        optimal_boot, info = BootSectorGenerator.generate_optimal_boot_sector(
+            _DAMAGED_BOOT, disk_size=20*1024*1024
         )
         
         # Verify boot signature
         self.assertEqual(optimal_boot[510:512], BOOT_SIGNATURE)
         
         # Verify some key fields
-        bytes_per_sector = struct.unpack('<H', optimal_boot[11:13])[0]
+        bytes_per_sector = _U16.unpack_from(optimal_boot, 11)[0]
         self.assertEqual(bytes_per_sector, 512)
         
         sectors_per_cluster = optimal_boot[13]
         self.assertEqual(sectors_per_cluster, 1)
+        
+        # Returned info should match the written fields
+        self.assertEqual(info['bytes_per_sector'], bytes_per_sector)
+        self.assertEqual(info['sectors_per_cluster'], sectors_per_cluster)
+        self.assertEqual(info['total_sectors'], 40960)
+        self.assertEqual(info['sectors_per_fat'], _U16.unpack_from(optimal_boot, 22)[0])
+    
+    def test_generated_info_matches_parser(self):
+        """Test the returned info equals parsing the generated boot sector"""
+        damaged_boots = (
+            (40960, _DAMAGED_BOOT),
+            (200000, bytes(32) + _U32.pack(200000) + bytes(476)),  # total sectors 32
+        )
+        for total_sectors, damaged_boot in damaged_boots:
+            with self.subTest(total_sectors=total_sectors):
+                optimal_boot, info = BootSectorGenerator.generate_optimal_boot_sector(damaged_boot)
+                self.assertEqual(info, BootSectorParser.parse_boot_sector(optimal_boot))
+                self.assertEqual(info['total_sectors'], total_sectors)
+                self.assertEqual(BootSectorValidator.validate_boot_sector(info), [])
+    
+    def test_generate_fat12_sectors_per_fat_is_integer(self):
+        """Test FAT12 sizing rounds up to whole sectors with integer math"""
+        cases = (
+            (2880, 9),  # 1.44MB floppy, 2847 clusters
+            (716, 3),   # 683 clusters -> 1025 FAT bytes; float math gave 2 sectors
+        )
+        for total_sectors, expected_spf in cases:
+            with self.subTest(total_sectors=total_sectors):
+                damaged_boot = bytes(19) + _U16.pack(total_sectors) + bytes(491)  # total sectors
+                
+                optimal_boot, info = BootSectorGenerator.generate_optimal_boot_sector(damaged_boot)
+                
+                self.assertIsInstance(info['sectors_per_fat'], int)
+                self.assertEqual(info['sectors_per_fat'], expected_spf)
+                self.assertEqual(_U16.unpack_from(optimal_boot, 22)[0], expected_spf)
+
+class TestFATAnalyzer(unittest.TestCase):
+    """Test FAT analyzer recovery helpers"""
+    
+    @classmethod
+    def setUpClass(cls):
+        """Build the FAT32 backup boot sector once per class"""
+        pack_u16, pack_u32 = _U16.pack_into, _U32.pack_into
+        buf = bytearray(512)
+        buf[3:11] = b'MSDOS5.0'
+        pack_u16(buf, 11, 512)  # bytes per sector
+        buf[13] = 8  # sectors per cluster
+        pack_u16(buf, 14, 32)  # reserved sectors
+        buf[16] = 2  # num fats
+        buf[21] = 0xF8  # media descriptor
+        pack_u32(buf, 32, 2000000)  # total sectors 32
+        pack_u32(buf, 36, 2000)  # sectors per fat 32
+        pack_u32(buf, 44, 2)  # root cluster
+        buf[510:512] = BOOT_SIGNATURE
+        cls.backup_boot = bytes(buf)
+    
+    def setUp(self):
+        """Set up an analyzer with a mocked disk reader"""
+        self.analyzer = FATAnalyzer('Z')
+        self.analyzer.disk_reader = mock.Mock()
+    
+    def test_find_backup_boot_sector(self):
+        """Test a valid backup boot sector is found with a single read"""
+        region = bytearray(7 * 512)  # sectors 6..12
+        region[0:512] = self.backup_boot
+        self.analyzer.disk_reader.read_sector.return_value = bytes(region)
+        
+        backup = self.analyzer._find_backup_boot_sector()
+        
+        self.assertIsNotNone(backup)
+        sector, data, info = backup
+        self.assertEqual(sector, 6)
+        self.assertEqual(data, self.backup_boot)
+        self.assertEqual(info['fat_type'], 32)
+        self.analyzer.disk_reader.read_sector.assert_called_once_with(6, 7)
+    
+    def test_find_backup_boot_sector_none(self):
+        """Test no backup is returned when the region holds no boot sector"""
+        self.analyzer.disk_reader.read_sector.return_value = bytes(7 * 512)
+        self.assertIsNone(self.analyzer._find_backup_boot_sector())
+    
+    def test_repair_with_backup_skips_recheck(self):
+        """Test a found backup is written without being parsed or validated again"""
+        self.analyzer.current_boot_sector = bytes(512)
+        backup = (6, self.backup_boot, {'fat_type': 32})
+        
+        with mock.patch.object(self.analyzer, '_find_backup_boot_sector', return_value=backup), \
+                mock.patch.object(self.analyzer, '_display_boot_sector_info'), \
+                mock.patch.object(self.analyzer, '_write_boot_sector', return_value=True) as write, \
+                mock.patch.object(BootSectorParser, 'parse_boot_sector') as parse, \
+                mock.patch.object(BootSectorValidator, 'validate_boot_sector') as validate, \
+                contextlib.redirect_stdout(io.StringIO()):
+            self.assertTrue(self.analyzer.repair_boot_sector(verify=True))
+        
+        parse.assert_not_called()
+        validate.assert_not_called()
+        write.assert_called_once_with(self.backup_boot)
+    
+    def test_write_failure_does_not_claim_unsaved_copy(self):
+        """Test the recovered file path is not reported when saving it failed"""
+        self.analyzer.current_boot_sector = bytes(512)
+        self.analyzer.disk_reader.write_sector.side_effect = Exception('access denied')
+        
+        buf = io.StringIO()
+        # Backup of the old sector succeeds, saving the recovered copy fails
+        with mock.patch('fat_analyzer.create_backup', side_effect=[True, False]), \
+                mock.patch('builtins.input', return_value='yes'), \
+                contextlib.redirect_stdout(buf):
+            self.assertFalse(self.analyzer._write_boot_sector(self.backup_boot))
+        
+        self.assertNotIn('Z_boot_recovered.bin', buf.getvalue())
 
 
 class TestDiskUtils(unittest.TestCase):
@@ -165,50 +322,132 @@ class TestDiskUtils(unittest.TestCase):
         test_data = b'test backup data'
         test_file = 'test_backup.tmp'
         
+        # Fake open in memory, no real file is written
+        with mock.patch('builtins.open', mock.mock_open()) as opener:
+            self.assertTrue(create_backup(test_file, test_data))
+        
+        opener.assert_called_once_with(test_file, 'wb')
+        opener().write.assert_called_once_with(test_data)
+    
+    def test_get_disk_size_cached(self):
+        """Test disk size is queried once per drive and failures are not cached"""
+        import disk_utils
+        disk_utils._disk_size_cache.pop('Z', None)
+        reader = DiskReader('z')
+        
         try:
-            # Create backup
-            result = create_backup(test_file, test_data)
-            self.assertTrue(result)
+            with mock.patch.object(DiskReader, '_query_disk_size', return_value=0) as query:
+                self.assertEqual(reader.get_disk_size(), 0)
+                self.assertEqual(reader.get_disk_size(), 0)
+                self.assertEqual(query.call_count, 2)
             
-            # Verify backup content
-            with open(test_file, 'rb') as f:
-                saved_data = f.read()
-            self.assertEqual(saved_data, test_data)
+            with mock.patch.object(DiskReader, '_query_disk_size', return_value=20*1024*1024) as query:
+                self.assertEqual(reader.get_disk_size(), 20*1024*1024)
+                self.assertEqual(DiskReader('Z').get_disk_size(), 20*1024*1024)
+                query.assert_called_once()
+        finally:
+            disk_utils._disk_size_cache.pop('Z', None)
+    
+    def test_disk_reader_session_reuses_handle(self):
+        """Test read_sector reuses one handle inside a DiskReader session"""
+        # Unique file per run so parallel runs do not collide
+        with tempfile.NamedTemporaryFile(suffix='.tmp', delete=False) as f:
+            f.write(b'\x11' * 512 + b'\x22' * 512)
+            test_file = f.name
+        
+        try:
+            reader = DiskReader('Z')
+            reader.drive_path = test_file
             
+            with mock.patch('builtins.open', wraps=open) as opener:
+                with reader:
+                    self.assertEqual(reader.read_sector(1), b'\x22' * 512)
+                    self.assertEqual(reader.read_sector(0), b'\x11' * 512)
+                self.assertEqual(opener.call_count, 1)
+                
+                # Outside a session every read reopens the file
+                reader.read_sector(0)
+                self.assertEqual(opener.call_count, 2)
         finally:
-            # Clean up
-            if os.path.exists(test_file):
-                os.remove(test_file)
+            try:
+                os.unlink(test_file)
+            except FileNotFoundError:
+                pass
     
     def test_hex_dump(self):
         """Test hex dump function"""
         test_data = b'\x00\x01\x02\x03\x04\x05\x06\x07'
         
-        # This should not raise any exception
-        try:
+        # Capture output in memory instead of printing to the test runner
+        buf = io.StringIO()
+        with contextlib.redirect_stdout(buf):
             hex_dump(test_data, max_bytes=8)
-        except Exception as e:
-            self.fail(f"hex_dump raised {type(e).__name__}: {e}")
+        self.assertIn('0000: 00 01 02 03 04 05 06 07', buf.getvalue())
+
+
+class TestCLI(unittest.TestCase):
+    """Test command line argument parsing"""
+    
+    def setUp(self):
+        """Set up a CLI with a fixed program name"""
+        self.cli = FATRecoveryCLI(prog='fat_recovery_modular.py')
+    
+    def test_parse_drive_only(self):
+        """Test a bare drive sets no flags"""
+        args = self.cli._parse_args(['E'])
+        self.assertEqual(args.drive, 'E')
+        self.assertFalse(args.recovery)
+        self.assertFalse(args.info_only)
+        self.assertFalse(args.verify)
+    
+    def test_parse_drive_with_colon(self):
+        """Test a drive given as E: is accepted as-is"""
+        self.assertEqual(self.cli._parse_args(['E:']).drive, 'E:')
+    
+    def test_parse_each_flag(self):
+        """Test each flag sets only its own attribute, before or after the drive"""
+        for flag, attr in (('--recovery', 'recovery'), ('--info-only', 'info_only'), ('--verify', 'verify')):
+            for argv in (['D', flag], [flag, 'D']):
+                with self.subTest(argv=argv):
+                    args = self.cli._parse_args(argv)
+                    self.assertEqual(args.drive, 'D')
+                    for name in ('recovery', 'info_only', 'verify'):
+                        self.assertEqual(getattr(args, name), name == attr)
+    
+    def test_parse_unknown_flag(self):
+        """Test an unknown flag raises ValueError"""
+        with self.assertRaisesRegex(ValueError, r'--force'):
+            self.cli._parse_args(['E', '--force'])
+    
+    def test_parse_extra_positional(self):
+        """Test a second positional argument raises ValueError"""
+        with self.assertRaisesRegex(ValueError, r'thừa: F'):
+            self.cli._parse_args(['E', 'F'])
+    
+    def test_parse_missing_drive(self):
+        """Test a missing drive raises ValueError"""
+        with self.assertRaises(ValueError):
+            self.cli._parse_args(['--recovery'])
+    
+    def test_help_matches_main(self):
+        """Test -h prints the same shared help as main.py and exits with 0"""
+        import main
+        cli_out, main_out = io.StringIO(), io.StringIO()
+        with contextlib.redirect_stdout(cli_out), self.assertRaises(SystemExit) as exit_ctx:
+            self.cli._parse_args(['-h'])
+        with mock.patch.object(sys, 'argv', ['fat_recovery_modular.py', '-h']), \
+                contextlib.redirect_stdout(main_out):
+            self.assertEqual(main.main(), 0)
+        
+        self.assertEqual(exit_ctx.exception.code, 0)
+        self.assertEqual(cli_out.getvalue(), main_out.getvalue())
+        self.assertIn('Ví dụ sử dụng', cli_out.getvalue())
 
 
 def run_tests():
     """Run all tests"""
-    # Create test suite
-    loader = unittest.TestLoader()
-    suite = unittest.TestSuite()
-    
-    # Add test cases
-    test_classes = [
-        TestConstants,
-        TestBootSectorParser,
-        TestBootSectorValidator,
-        TestBootSectorGenerator,
-        TestDiskUtils
-    ]
-    
-    for test_class in test_classes:
-        tests = loader.loadTestsFromTestCase(test_class)
-        suite.addTests(tests)
+    # Load every TestCase in this module, no class list to maintain
+    suite = unittest.TestLoader().loadTestsFromModule(sys.modules[__name__])
     
     # Run tests
     runner = unittest.TextTestRunner(verbosity=2)